@@ -14,19 +14,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+
 from quart import Blueprint, current_app as app
 from quart_auth import basic_auth_required
 
+from services.cache import cache_response_for
+
 api = Blueprint('api', __name__)
 
 
 @api.get("/power/fromgrid/current")
 @basic_auth_required()
+@cache_response_for(seconds=5)
 async def get_current_power_fromgrid():
-    result = app.services.influx.get_current_power_fromgrid()
+    result = await asyncio.to_thread(
+        app.services.influx.get_current_power_fromgrid)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -34,11 +40,12 @@ async def get_current_power_fromgrid():
 
 @api.get("/power/net/current")
 @basic_auth_required()
+@cache_response_for(seconds=5)
 async def get_current_power_net():
-    result = app.services.influx.get_current_power_net()
+    result = await asyncio.to_thread(app.services.influx.get_current_power_net)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -46,11 +53,13 @@ async def get_current_power_net():
 
 @api.get("/production/current")
 @basic_auth_required()
+@cache_response_for(seconds=5)
 async def get_current_production():
-    result = app.services.influx.get_current_production()
+    result = await asyncio.to_thread(
+        app.services.influx.get_current_production)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -58,11 +67,13 @@ async def get_current_production():
 
 @api.get("/consumption/current")
 @basic_auth_required()
+@cache_response_for(seconds=5)
 async def get_current_consumption():
-    result = app.services.influx.get_current_consumption()
+    result = await asyncio.to_thread(
+        app.services.influx.get_current_consumption)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -70,12 +81,14 @@ async def get_current_consumption():
 
 @api.get("/consumption/baseline")
 @basic_auth_required()
+@cache_response_for(seconds=300)
 async def get_baseline_consumption():
-    result = app.services.influx.get_baseline_consumption()
+    result = await asyncio.to_thread(
+        app.services.influx.get_baseline_consumption)
 
     return {
-        'start': result.start.isoformat(),
-        'end': result.end.isoformat(),
+        'start': result.start,
+        'end': result.end,
         'unit': result.unit,
         'q25': result.q25,
         'q50': result.q50,
@@ -86,11 +99,13 @@ async def get_baseline_consumption():
 
 @api.get("/legionella/last")
 @basic_auth_required()
+@cache_response_for(seconds=300)
 async def get_last_legionella_start():
-    result = app.services.influx.get_last_legionella_start()
+    result = await asyncio.to_thread(
+        app.services.influx.get_last_legionella_start)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -98,11 +113,12 @@ async def get_last_legionella_start():
 
 @api.get("/dhw/temp")
 @basic_auth_required()
+@cache_response_for(seconds=5)
 async def get_current_dhw_temp():
-    result = app.services.influx.get_current_dhw_temp()
+    result = await asyncio.to_thread(app.services.influx.get_current_dhw_temp)
 
     return {
-        'timestamp': result.timestamp.isoformat(),
+        'timestamp': result.timestamp,
         'value': result.value,
         'unit': result.unit
     }
@@ -110,8 +126,10 @@ async def get_current_dhw_temp():
 
 @api.get("/heatpump/status")
 @basic_auth_required()
+@cache_response_for(seconds=30)
 async def get_current_heatpump_status():
-    result = app.services.influx.get_current_heatpump_status()
+    result = await asyncio.to_thread(
+        app.services.influx.get_current_heatpump_status)
 
     return {
         'operating_mode': result.operating_mode,
@@ -122,8 +140,9 @@ async def get_current_heatpump_status():
 
 @api.get("/heatpump/setpoint")
 @basic_auth_required()
+@cache_response_for(seconds=30)
 async def get_heatpump_setpoint():
-    result = app.services.influx.get_heatpump_setpoint()
+    result = await asyncio.to_thread(app.services.influx.get_heatpump_setpoint)
 
     return {
         'dhw': result.dhw,
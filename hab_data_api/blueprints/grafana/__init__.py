@@ -14,23 +14,52 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
-import pytz
+import time
 
 from dateutil.relativedelta import relativedelta
 
-from quart import Blueprint, request, current_app as app
+from quart import Blueprint, request, stream_with_context, current_app as app
 from quart_auth import basic_auth_required
 
+from utils.time import BRUSSELS
+
 grafana = Blueprint('grafana', __name__)
 
+backend_semaphore = asyncio.Semaphore(10)
+
+OPERATING_MODES = {
+    'Stop': '⏻',
+    'Heating': '🏡',
+    'Heating eco': '🛖',
+    'Hot water': '🛀',
+    'Freeze stat': '❄',
+    'Legionella': '🌶'
+}
+
+HEAT_SOURCES = {
+    'Heatpump': '✇',
+    'Heatpump pause': '⏼︎',
+    'Immersion heater': '⚡',
+    'Backup heater': '⚡',
+    'Immersion and backup heater': '⚡',
+    'Boiler': '🔥'
+}
+
+DEFROST_STATUSES = {
+    'Standby': '⏼︎❄',
+    'Defrost': '❄',
+    'Waiting restart': '⏼︎❄'
+}
+
 
 def get_range(data):
-    date_from = pytz.utc.localize(datetime.datetime.strptime(
-        data['range']['from'][:-5], '%Y-%m-%dT%H:%M:%S')).astimezone(pytz.timezone('Europe/Brussels'))
+    date_from = datetime.datetime.fromisoformat(
+        data['range']['from'].replace('Z', '+00:00')).astimezone(BRUSSELS)
 
-    date_to = pytz.utc.localize(datetime.datetime.strptime(
-        data['range']['to'][:-5], '%Y-%m-%dT%H:%M:%S')).astimezone(pytz.timezone('Europe/Brussels'))
+    date_to = datetime.datetime.fromisoformat(
+        data['range']['to'].replace('Z', '+00:00')).astimezone(BRUSSELS)
 
     return date_from, date_to
 
@@ -39,6 +68,39 @@ def get_targets(data):
     return [i['target'] for i in data['targets']]
 
 
+def to_timestamp_ms(value):
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(
+            value, datetime.time(), tzinfo=BRUSSELS)
+    return int(value.timestamp() * 1000)
+
+
+def to_datapoints(series):
+    return list(map(list, zip(
+        series.tolist(), series.index.as_unit('ms').asi8.tolist())))
+
+
+async def run_in_thread(fn, *args):
+    async with backend_semaphore:
+        return await asyncio.to_thread(fn, *args)
+
+
+class QueryContext:
+    def __init__(self, date_from, date_to, now):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.now = now
+
+        self.calls = {}
+
+    def call(self, fn, *args):
+        # targets of the same request share identical backend calls
+        key = (fn, args)
+        if key not in self.calls:
+            self.calls[key] = asyncio.ensure_future(run_in_thread(fn, *args))
+        return self.calls[key]
+
+
 @grafana.get("/")
 @basic_auth_required()
 async def test_connection():
@@ -72,198 +134,231 @@ async def get_metric_payload_options():
     return []
 
 
+async def heatpump_status(ctx):
+    hs = await ctx.call(app.services.influx.get_current_heatpump_status)
+
+    r = ''
+    if hs.defrost_status != 'Normal':
+        r = DEFROST_STATUSES.get(hs.defrost_status)
+    elif hs.operating_mode == 'Stop':
+        r = OPERATING_MODES.get(hs.operating_mode)
+    elif hs.heat_source == 'Heatpump pause':
+        r = HEAT_SOURCES.get(hs.heat_source)
+    else:
+        r += OPERATING_MODES.get(hs.operating_mode, '?')
+        r += ' ' + HEAT_SOURCES.get(hs.heat_source, '?')
+
+    datapoints = [[r, ctx.now]]
+
+    return [{
+        'target': 'heatpump_status',
+        'datapoints': datapoints
+    }]
+
+
+async def baseline_consumption(ctx):
+    bc = await ctx.call(app.services.influx.get_baseline_consumption)
+    bc = bc.q50 + (1.5 * bc.stddev) / 1000
+
+    datapoints = [
+        [bc, to_timestamp_ms(ctx.date_from)],
+        [bc, to_timestamp_ms(ctx.date_to)]
+    ]
+
+    return [{
+        'target': 'baseline_consumption',
+        'datapoints': datapoints
+    }]
+
+
+async def price_hourly(ctx):
+    start_date = ctx.date_from.date()
+    end_date = ctx.date_to.date() + datetime.timedelta(days=1)
+
+    df = await ctx.call(
+        app.services.price.get_hourly_price, start_date, end_date)
+
+    datapoints = to_datapoints(df.total)
+
+    return [{
+        'target': 'price_hourly',
+        'datapoints': datapoints
+    }]
+
+
+async def price_daily(ctx):
+    start_date = ctx.date_to.date() - datetime.timedelta(days=10)
+    end_date = ctx.date_to.date() + datetime.timedelta(days=1)
+
+    df = await ctx.call(
+        app.services.price.get_daily_price, start_date, end_date)
+
+    datapoints = to_datapoints(df.total)
+
+    return [{
+        'target': 'price_daily',
+        'datapoints': datapoints
+    }]
+
+
+async def price_this_month(ctx):
+    start_date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+    end_date = start_date + relativedelta(months=1)
+
+    df = await ctx.call(
+        app.services.price.get_monthly_price, start_date, end_date)
+
+    datapoints = to_datapoints(df.total)
+
+    return [{
+        'target': 'price_this_month',
+        'datapoints': datapoints
+    }]
+
+
+async def price_detail(ctx, start_date, end_date):
+    df = await ctx.call(
+        app.services.price.get_monthly_price, start_date, end_date)
+
+    if df.empty:
+        return []
+
+    timestamp = to_timestamp_ms(start_date)
+
+    return [{
+        'target': column,
+        'datapoints': [[value, timestamp]]
+    } for column, value in zip(df.columns, df.iloc[0].tolist())]
+
+
+async def price_detail_this_month(ctx):
+    start_date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+    end_date = start_date + relativedelta(months=1)
+
+    return await price_detail(ctx, start_date, end_date)
+
+
+async def price_detail_previous_month(ctx):
+    start_date = datetime.date(
+        ctx.date_to.year, ctx.date_to.month, 1) - relativedelta(months=1)
+    end_date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+
+    return await price_detail(ctx, start_date, end_date)
+
+
+async def current_month_peak(ctx):
+    peak = await ctx.call(app.services.influx.get_current_month_peak)
+
+    datapoints = [
+        [peak, to_timestamp_ms(ctx.date_from)],
+        [peak, to_timestamp_ms(ctx.date_to)]
+    ]
+
+    return [{
+        'target': 'current_month_peak',
+        'datapoints': datapoints
+    }]
+
+
+async def invoice_peak(ctx):
+    date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+    peak = await ctx.call(
+        app.services.influx.get_invoice_peak,
+        ctx.date_to.year, ctx.date_to.month)
+
+    datapoints = [
+        [peak, to_timestamp_ms(date)]
+    ]
+
+    return [{
+        'target': 'invoice_peak',
+        'datapoints': datapoints
+    }]
+
+
+async def belpex_this_month(ctx):
+    date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+    belpex = await ctx.call(
+        app.services.influx.get_monthly_belpex, date.year, date.month)
+
+    datapoints = [
+        [belpex, to_timestamp_ms(date)]
+    ]
+
+    return [{
+        'target': 'belpex_this_month',
+        'datapoints': datapoints
+    }]
+
+
+async def belpex_previous_month(ctx):
+    date = datetime.date(ctx.date_to.year, ctx.date_to.month, 1)
+    date = date - relativedelta(months=1)
+    belpex = await ctx.call(
+        app.services.influx.get_monthly_belpex, date.year, date.month)
+
+    datapoints = [
+        [belpex, to_timestamp_ms(date)]
+    ]
+
+    return [{
+        'target': 'belpex_previous_month',
+        'datapoints': datapoints
+    }]
+
+
+HANDLERS = {
+    'heatpump_status': heatpump_status,
+    'baseline_consumption': baseline_consumption,
+    'price_hourly': price_hourly,
+    'price_daily': price_daily,
+    'price_this_month': price_this_month,
+    'price_detail_this_month': price_detail_this_month,
+    'price_detail_previous_month': price_detail_previous_month,
+    'current_month_peak': current_month_peak,
+    'invoice_peak': invoice_peak,
+    'belpex_this_month': belpex_this_month,
+    'belpex_previous_month': belpex_previous_month
+}
+
+
 @grafana.post("/query")
 @basic_auth_required()
 async def query():
     data = await request.json
 
     date_from, date_to = get_range(data)
-    targets = get_targets(data)
+    targets = list(dict.fromkeys(get_targets(data)))
+
+    unknown_targets = [t for t in targets if t not in HANDLERS]
+    if len(unknown_targets) > 0:
+        return {'error': 'unknown targets', 'targets': unknown_targets}, 400
 
     date_from = date_from - datetime.timedelta(minutes=10)
     date_to = date_to + datetime.timedelta(minutes=10)
 
-    now = int(datetime.datetime.now().strftime('%s'))*1000
-
-    result = []
-
-    for t in targets:
-        if t == 'heatpump_status':
-            hs = app.services.influx.get_current_heatpump_status()
-
-            operating_modes = {
-                'Stop': '⏻',
-                'Heating': '🏡',
-                'Heating eco': '🛖',
-                'Hot water': '🛀',
-                'Freeze stat': '❄',
-                'Legionella': '🌶'
-            }
-
-            heat_sources = {
-                'Heatpump': '✇',
-                'Heatpump pause': '⏼︎',
-                'Immersion heater': '⚡',
-                'Backup heater': '⚡',
-                'Immersion and backup heater': '⚡',
-                'Boiler': '🔥'
-            }
-
-            defrost_statuses = {
-                'Standby': '⏼︎❄',
-                'Defrost': '❄',
-                'Waiting restart': '⏼︎❄'
-            }
-
-            r = ''
-            if hs.defrost_status != 'Normal':
-                r = defrost_statuses.get(hs.defrost_status)
-            elif hs.operating_mode == 'Stop':
-                r = operating_modes.get(hs.operating_mode)
-            elif hs.heat_source == 'Heatpump pause':
-                r = heat_sources.get(hs.heat_source)
-            else:
-                r += operating_modes.get(hs.operating_mode, '?')
-                r += ' ' + heat_sources.get(hs.heat_source, '?')
-
-            datapoints = [[r, now]]
-
-            result.append({
-                'target': 'heatpump_status',
-                'datapoints': datapoints
-            })
-        elif t == 'baseline_consumption':
-            bc = app.services.influx.get_baseline_consumption()
-            bc = bc.q50 + (1.5 * bc.stddev) / 1000
-
-            datapoints = [
-                [bc, int(date_from.strftime('%s'))*1000],
-                [bc, int(date_to.strftime('%s'))*1000]
-            ]
-
-            result.append({
-                'target': 'baseline_consumption',
-                'datapoints': datapoints
-            })
-        elif t == 'price_hourly':
-            start_date = date_from.date()
-            end_date = date_to.date() + datetime.timedelta(days=1)
-
-            df = app.services.price.get_hourly_price(start_date, end_date)
-
-            datapoints = [
-                [i.total, int(i.Index.strftime('%s'))*1000] for i in df.itertuples()
-            ]
-
-            result.append({
-                'target': 'price_hourly',
-                'datapoints': datapoints
-            })
-        elif t == 'price_daily':
-            start_date = date_to.date() - datetime.timedelta(days=10)
-            end_date = date_to.date() + datetime.timedelta(days=1)
-
-            df = app.services.price.get_daily_price(start_date, end_date)
-
-            datapoints = [
-                [i.total, int(i.Index.strftime('%s'))*1000] for i in df.itertuples()
-            ]
-
-            result.append({
-                'target': 'price_daily',
-                'datapoints': datapoints
-            })
-        elif t == 'price_this_month':
-            start_date = datetime.date(date_to.year, date_to.month, 1)
-            end_date = start_date + relativedelta(months=1)
-
-            df = app.services.price.get_monthly_price(start_date, end_date)
-
-            datapoints = [
-                [i.total, int(i.Index.strftime('%s'))*1000] for i in df.itertuples()
-            ]
-
-            result.append({
-                'target': 'price_this_month',
-                'datapoints': datapoints
-            })
-        elif t == 'price_detail_this_month':
-            start_date = datetime.date(date_to.year, date_to.month, 1)
-            end_date = start_date + relativedelta(months=1)
-
-            df = app.services.price.get_monthly_price(start_date, end_date)
-            details = list(df)
-
-            for i in details:
-                result.append({
-                    'target': i,
-                    'datapoints': [[df.iloc[0][i], int(start_date.strftime('%s'))*1000]]
-                })
-        elif t == 'price_detail_previous_month':
-            start_date = datetime.date(
-                date_to.year, date_to.month, 1) - relativedelta(months=1)
-            end_date = datetime.date(date_to.year, date_to.month, 1)
-
-            df = app.services.price.get_monthly_price(start_date, end_date)
-            details = list(df)
-
-            for i in details:
-                result.append({
-                    'target': i,
-                    'datapoints': [[df.iloc[0][i], int(start_date.strftime('%s'))*1000]]
-                })
-        elif t == 'current_month_peak':
-            peak = app.services.influx.get_current_month_peak()
-
-            datapoints = [
-                [peak, int(date_from.strftime('%s'))*1000],
-                [peak, int(date_to.strftime('%s'))*1000]
-            ]
-
-            result.append({
-                'target': 'current_month_peak',
-                'datapoints': datapoints
-            })
-        elif t == 'invoice_peak':
-            date = datetime.date(date_to.year, date_to.month, 1)
-            peak = app.services.influx.get_invoice_peak(
-                date_to.year, date_to.month)
-
-            datapoints = [
-                [peak, int(date.strftime('%s'))*1000]
-            ]
-
-            result.append({
-                'target': 'invoice_peak',
-                'datapoints': datapoints
-            })
-        elif t == 'belpex_this_month':
-            date = datetime.date(date_to.year, date_to.month, 1)
-            belpex = app.services.influx.get_monthly_belpex(
-                date.year, date.month)
-
-            datapoints = [
-                [belpex, int(date.strftime('%s'))*1000]
-            ]
-
-            result.append({
-                'target': 'belpex_this_month',
-                'datapoints': datapoints
-            })
-        elif t == 'belpex_previous_month':
-            date = datetime.date(date_to.year, date_to.month, 1)
-            date = date - relativedelta(months=1)
-            belpex = app.services.influx.get_monthly_belpex(
-                date.year, date.month)
-
-            datapoints = [
-                [belpex, int(date.strftime('%s'))*1000]
-            ]
-
-            result.append({
-                'target': 'belpex_previous_month',
-                'datapoints': datapoints
-            })
-
-
-    return result
+    now = int(time.time() * 1000)
+
+    ctx = QueryContext(date_from, date_to, now)
+
+    tasks = [asyncio.ensure_future(HANDLERS[t](ctx)) for t in targets]
+
+    @stream_with_context
+    async def stream_result():
+        # write each target as soon as it is available
+        separator = b''
+
+        yield b'['
+        for task in asyncio.as_completed(tasks):
+            try:
+                part = await task
+            except Exception as e:
+                app.log.error('Failed to query Grafana target: %r', e)
+                continue
+
+            for item in part:
+                yield separator + app.json.dumps(item).encode()
+                separator = b','
+        yield b']'
+
+    return app.response_class(stream_result(), content_type='application/json')
@@ -14,36 +14,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import datetime
-import httpx
-import pytz
-
-from dto.generic import TimeDataDto
+import orjson
 
+import pandas as pd
 
-def to_brussels_time(datetime_utc):
-    return datetime_utc.replace(tzinfo=pytz.utc).astimezone(
-        pytz.timezone('Europe/Brussels'))
+from dto.generic import TimeDataDto
+from utils.time import BRUSSELS
 
 
 class GridDataClient:
-    def __init__(self, app):
+    def __init__(self, app, client):
         self.app = app
+        self.client = client
 
         self.base_url = 'https://griddata.elia.be/eliabecontrols.prod/interface/Interconnections/daily/auctionresultsqh/'
 
-        self.client = httpx.AsyncClient()
-
     async def get_grid_prices(self, date):
-        date = date.strftime('%Y-%m-%d')
-        url = f'{self.base_url}/{date}'
+        response = await self.client.get(
+            self.base_url + date.strftime('%Y-%m-%d'))
+        grid_data = orjson.loads(response.content)
+        timestamps = pd.to_datetime(
+            [i['dateTime'] for i in grid_data],
+            format='%Y-%m-%dT%H:%M:%SZ', utc=True
+        ).tz_convert(BRUSSELS).to_pydatetime()
 
-        grid_data = (await self.client.get(url)).json()
         return [TimeDataDto(
-            timestamp=to_brussels_time(datetime.datetime.strptime(
-                i['dateTime'], '%Y-%m-%dT%H:%M:%SZ')),
+            timestamp=timestamp,
             value=i['price']/10,
-            unit='c€/kWh') for i in grid_data]
-
-    async def shutdown(self):
-        await self.client.aclose()
+            unit='c€/kWh') for timestamp, i in zip(timestamps, grid_data)]
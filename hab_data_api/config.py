@@ -14,13 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import os
 
 
+@functools.lru_cache(maxsize=None)
 def read_secret(variable_name):
     if f'{variable_name}_FILE' in os.environ:
         with open(os.environ.get(f'{variable_name}_FILE'), 'r') as secret_file:
-            secret = secret_file.read()
+            secret = secret_file.read().rstrip('\n')
     else:
         secret = os.environ.get(variable_name, None)
     return secret
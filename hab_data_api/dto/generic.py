@@ -3,14 +3,14 @@ from dataclasses import dataclass
 import datetime
 
 
-@dataclass
+@dataclass(slots=True)
 class TimeDataDto:
     timestamp: datetime.datetime
     value: float
     unit: str
 
 
-@dataclass
+@dataclass(slots=True)
 class TimePeriodStatsDto:
     start: datetime.datetime
     end: datetime.datetime
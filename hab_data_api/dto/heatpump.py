@@ -1,14 +1,14 @@
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class HeatPumpStatusDto:
     operating_mode: str
     heat_source: str
     defrost_status: str
 
 
-@dataclass
+@dataclass(slots=True)
 class HeatPumpSetpointDto:
     dhw: float
     heating: float
@@ -15,9 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import datetime
 import logging
 
+import httpx
+import orjson
+
 from quart import Quart
+from quart.json.provider import DefaultJSONProvider
 from quart_auth import QuartAuth
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -46,13 +51,23 @@ class Clients:
             host=self.app.config['INFLUX_HOST'],
             database=self.app.config['INFLUX_DATABASE'],
             username=self.app.config['INFLUX_USERNAME'],
-            password=self.app.config['INFLUX_PASSWORD'])
+            password=self.app.config['INFLUX_PASSWORD'],
+            pool_size=32,
+            gzip=True)
+
+        self.httpx = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=100,
+                keepalive_expiry=60.0),
+            timeout=30.0)
 
-        self.griddata = GridDataClient(self.app)
+        self.griddata = GridDataClient(self.app, self.httpx)
 
     async def shutdown(self):
         await asyncio.gather(
-            self.griddata.shutdown()
+            self.httpx.aclose()
         )
 
 
@@ -66,37 +81,40 @@ class Services:
         self.price = PriceService(self.app)
 
 
-class Logger:
-    def __init__(self, app):
-        self.app = app
-        self.logger = logging.getLogger('hab_data_api')
-        hdlr = logging.StreamHandler()
-        hdlr.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-        self.logger.addHandler(hdlr)
-        self.logger.setLevel(logging.DEBUG)
+def create_logger():
+    logger = logging.getLogger('hab_data_api')
+    hdlr = logging.StreamHandler()
+    hdlr.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    logger.addHandler(hdlr)
+    logger.setLevel(logging.DEBUG)
+    return logger
 
-    def log(self, *args, **kwargs):
-        return self.logger.log(*args, **kwargs)
 
-    def debug(self, message):
-        return self.log(logging.DEBUG, message)
+class OrjsonProvider(DefaultJSONProvider):
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
 
-    def info(self, message):
-        return self.log(logging.INFO, message)
+    @staticmethod
+    def default(o):
+        # datetime subclasses such as pandas' Timestamp
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
 
-    def warning(self, message):
-        return self.log(logging.WARNING, message)
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj, default=self.default, option=self.option).decode()
 
-    def error(self, message):
-        return self.log(logging.ERROR, message)
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 
 app = Quart(__name__)
+app.json = OrjsonProvider(app)
 app.config.from_object(Config)
 app.secret_key = app.config['SECRET_KEY']
 
 app.auth = QuartAuth(app)
-app.log = Logger(app)
+app.log = create_logger()
 
 
 @app.before_serving
@@ -36,11 +36,33 @@ class BelpexService:
 
         date_to = datetime.date.today() + datetime.timedelta(days=1)
 
-        date_to_fetch = date_from
-        while date_to_fetch <= date_to:
-            data = await self.client.get_grid_prices(date_to_fetch)
-            self.app.services.influx.save_grid_prices(data)
-            date_to_fetch = date_to_fetch + datetime.timedelta(days=1)
+        dates_to_fetch = [
+            date_from + datetime.timedelta(days=i)
+            for i in range((date_to - date_from).days + 1)]
+
+        semaphore = asyncio.Semaphore(8)
+
+        async def fetch(date):
+            async with semaphore:
+                return await self.client.get_grid_prices(date)
+
+        results = await asyncio.gather(
+            *[fetch(d) for d in dates_to_fetch], return_exceptions=True)
+
+        # only save up to the first failed day, so it is fetched again next run
+        data = []
+        complete = True
+        for date, result in zip(dates_to_fetch, results):
+            if isinstance(result, Exception):
+                self.app.log.warning(
+                    'Failed to fetch grid prices for %s: %r', date, result)
+                complete = False
+            elif complete:
+                data.extend(result)
+
+        if len(data) > 0:
+            await asyncio.to_thread(
+                self.app.services.influx.save_grid_prices, data)
 
     def __scheduled_jobs(self):
         self.app.scheduler.add_job(
@@ -1,26 +1,126 @@
-import datetime
-import zlib
+import collections
+import functools
+import threading
+import time
 
-CACHE = {}
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from quart import request, current_app as app
+from requests.exceptions import RequestException
 
+CACHE = collections.OrderedDict()
+CACHE_SIZE = 1024
+CACHE_LOCK = threading.Lock()
+KEY_LOCKS = {}
 
-def cache_for(seconds):
+# database failures for which a recently expired response is served instead
+BACKEND_ERRORS = (InfluxDBClientError, InfluxDBServerError, RequestException)
+STALE_TTLS = 3
+
+
+def get_cached(key):
+    with CACHE_LOCK:
+        if key not in CACHE:
+            return None, None
+        CACHE.move_to_end(key)
+        return CACHE[key]
+
+
+def set_cached(key, value, seconds):
+    with CACHE_LOCK:
+        CACHE[key] = (time.monotonic() + seconds, value)
+        CACHE.move_to_end(key)
+        while len(CACHE) > CACHE_SIZE:
+            evicted, _ = CACHE.popitem(last=False)
+            drop_key_lock(evicted)
+
+
+def drop_key_lock(key):
+    # a held lock stays, so callers arriving meanwhile still wait on it
+    lock = KEY_LOCKS.get(key)
+    if lock is not None and not lock.locked():
+        del KEY_LOCKS[key]
+
+
+def get_key_lock(key):
+    with CACHE_LOCK:
+        return KEY_LOCKS.setdefault(key, threading.Lock())
+
+
+def cache_for(seconds, negative_ttl=None):
     def cache(fn):
+        def get_key(args, kwargs):
+            key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                key = (fn.__name__, repr(args), repr(sorted(kwargs.items())))
+            return key
+
+        @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            fn_hash_base = fn.__name__
-            fn_hash_base += str(args)
-            fn_hash_base += str(kwargs)
-            fn_hash = zlib.crc32(fn_hash_base.encode('utf8')) & 0xffffffff
+            key = get_key(args, kwargs)
 
-            timestamp, cache = CACHE.get(fn_hash, (None, None))
+            deadline, cache = get_cached(key)
 
-            if timestamp is not None and cache is not None \
-                    and timestamp >= datetime.datetime.now() - datetime.timedelta(seconds=seconds):
+            if deadline is not None and deadline > time.monotonic():
                 return cache
 
-            result = fn(*args, **kwargs)
-            CACHE[fn_hash] = (datetime.datetime.now(), result)
-            return result
+            # only one caller computes a missing entry, the others wait for it
+            with get_key_lock(key):
+                deadline, cache = get_cached(key)
+
+                if deadline is not None and deadline > time.monotonic():
+                    return cache
+
+                result = fn(*args, **kwargs)
+                store(key, result)
+                return result
+
+        def store(key, result):
+            # empty results are only cached when asked for, and briefly
+            if result is not None:
+                set_cached(key, result, seconds)
+            elif negative_ttl is not None:
+                set_cached(key, result, negative_ttl)
+
+        def refresh(*args, **kwargs):
+            key = get_key(args, kwargs)
+
+            # shares the flight with callers missing the cache meanwhile
+            with get_key_lock(key):
+                result = fn(*args, **kwargs)
+                store(key, result)
+                return result
+
+        wrapper.refresh = refresh
+        return wrapper
+    return cache
+
+
+def cache_response_for(seconds):
+    def cache(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = ('api', request.path, request.query_string)
+
+            deadline, cache = get_cached(key)
+
+            if cache is not None and deadline > time.monotonic():
+                return app.response_class(cache, content_type='application/json')
+
+            try:
+                result = await fn(*args, **kwargs)
+            except BACKEND_ERRORS as e:
+                if cache is None or \
+                        time.monotonic() > deadline + seconds * STALE_TTLS:
+                    raise
+                app.log.warning(
+                    'Returning stale response for %s: %s', request.path, e)
+                return app.response_class(cache, content_type='application/json')
+
+            body = app.json.dumps(result)
+            set_cached(key, body, seconds)
+            return app.response_class(body, content_type='application/json')
         return wrapper
     return cache
 
@@ -32,7 +132,12 @@ class CacheService:
         self.__scheduled_jobs()
 
     def clear_cache(self):
-        CACHE.clear()
+        # this also drops the locks of uncached (None) results, which are
+        # never evicted from CACHE
+        with CACHE_LOCK:
+            CACHE.clear()
+            for key in list(KEY_LOCKS):
+                drop_key_lock(key)
 
     def __scheduled_jobs(self):
         self.app.scheduler.add_job(
@@ -14,21 +14,147 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import datetime
 from dateutil.relativedelta import relativedelta
 
+import numpy as np
 import pandas as pd
 
-import pytz
-
 from dto.generic import TimeDataDto, TimePeriodStatsDto
 from dto.heatpump import HeatPumpStatusDto, HeatPumpSetpointDto
 from services.cache import cache_for
-
-def to_brussels_time(datetime_utc):
-    return datetime_utc.replace(tzinfo=pytz.utc).astimezone(
-        pytz.timezone('Europe/Brussels'))
-
+from utils.time import BRUSSELS, to_epoch_ns
+
+
+QUERY_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+OPERATING_MODES = {
+    0: 'Stop',
+    1: 'Hot water',
+    2: 'Heating',
+    3: 'Cooling',
+    4: 'No voltage contact input (hot water storage)',
+    5: 'Freeze stat',
+    6: 'Legionella',
+    7: 'Heating eco',
+    8: 'Mode 1',
+    9: 'Mode 2',
+    10: 'Mode 3',
+    11: 'No voltage contact input (heating up)'
+}
+
+HEAT_SOURCES = {
+    0: 'Heatpump',
+    1: 'Immersion heater',
+    2: 'Backup heater',
+    3: 'Immersion and backup heater',
+    4: 'Boiler'
+}
+
+DEFROST_STATUSES = {
+    0: 'Normal',
+    1: 'Standby',
+    2: 'Defrost',
+    3: 'Waiting restart'
+}
+
+BASELINE_CONSUMPTION_QUERY = """
+SELECT difference(last(value)) as value from p1_elec_total_fromgrid
+where time > $start and time <= $end
+group by rate, time(5m) tz('Europe/Brussels');
+SELECT difference(last(value)) as value from p1_elec_total_togrid
+where time > $start and time <= $end
+group by rate, time(5m) tz('Europe/Brussels');
+SELECT difference(last(value)) as value from accumulated_yield_energy
+where time > $start and time <= $end
+group by time(5m) tz('Europe/Brussels')
+"""
+
+CURRENT_PRODUCTION_QUERY = """
+select value from active_power where time >= $start order by time desc limit 1
+"""
+
+TANK_TEMP_QUERY = """
+SELECT value FROM ecodan2_tank_temp where time >= $start
+"""
+
+HEATPUMP_STATUS_QUERY = """
+select last(value) from ecodan2_operating_mode, ecodan2_heat_source,
+ecodan2_pump_freq, ecodan2_defrost_status where time >= $start
+"""
+
+HEATPUMP_SETPOINT_QUERY = """
+select value from ecodan2_tank_set_temp where time >= $start order by time desc limit 1;
+select value from ecodan2_house_set_temp where time >= $start order by time desc limit 1
+"""
+
+CURRENT_DHW_TEMP_QUERY = """
+select value from ecodan2_tank_temp where time >= $start order by time desc limit 1
+"""
+
+PEAK_QUERY = """
+select max(peak) as peak from (
+    select sum(peak) as peak from (
+        SELECT difference(last(value)) *4 as peak, first(month) as month, first(year) as year
+        from "persist".p1_elec_total_fromgrid_max
+        where time >= $start and time < $end - 15m
+        group by rate, month, year, time(15m) tz('Europe/Brussels')
+    ) group by month, year, time(15m) tz('Europe/Brussels')
+) group by month, year
+"""
+
+MONTHLY_BELPEX_QUERY = """
+select mean(value) as belpex from "persist".belpex_grid_prices
+where "year" = $year and "month" = $month
+"""
+
+HOURLY_CONSUMPTION_QUERY = """
+select difference(last(value)) as consumption
+from persist.p1_elec_total_fromgrid
+where time >= $start and time < $end
+group by rate, time(1h) tz('Europe/Brussels')
+"""
+
+HOURLY_INJECTION_QUERY = """
+select difference(last(value)) as injection
+from persist.p1_elec_total_togrid
+where time >= $start and time < $end
+group by rate, time(1h) tz('Europe/Brussels')
+"""
+
+
+def drop_last(points):
+    # yield all points but the last, without materializing the result first
+    previous = None
+    for point in points:
+        if previous is not None:
+            yield previous
+        previous = point
+
+
+def rates_to_frames(rs, column):
+    # one frame per tariff rate, indexed on the Brussels time
+    points_per_rate = {}
+    for (_, tags), points in rs.items():
+        times = []
+        values = []
+        for r in points:
+            times.append(r['time'])
+            values.append(r[column])
+        points_per_rate[tags['rate']] = (times, values)
+
+    frames = []
+    for rate in ('rate1', 'rate2'):
+        times, values = points_per_rate.get(rate, ([], []))
+        if len(times) > 0:
+            index = pd.to_datetime(
+                times, format='%Y-%m-%dT%H:%M:%SZ', utc=True
+            ).tz_convert(BRUSSELS).rename('time')
+            frames.append(pd.DataFrame(
+                {f'{column}_{rate}': values}, index=index))
+
+    return frames
 
 
 class InfluxService:
@@ -36,25 +162,43 @@ class InfluxService:
         self.app = app
         self.client = self.app.clients.influx
 
+        self.__scheduled_jobs()
+
+    def update_current_values(self):
+        # keep the readings behind the current value endpoints warm, so
+        # requests are served from the cache instead of waiting on Influx
+        for getter in (InfluxService.get_current_power_net,
+                       InfluxService.get_current_production,
+                       InfluxService.get_current_dhw_temp,
+                       InfluxService.get_current_heatpump_status,
+                       InfluxService.get_heatpump_setpoint):
+            try:
+                getter.refresh(self)
+            except Exception as e:
+                self.app.log.warning(
+                    'Failed to refresh %s: %r', getter.__name__, e)
+
     def get_current_power_fromgrid(self):
         current_power_net = self.get_current_power_net()
+        power_net = current_power_net.value
 
         return TimeDataDto(
             timestamp=current_power_net.timestamp,
-            value=max(0, current_power_net.value),
+            value=power_net if power_net > 0 else 0,
             unit='W'
         )
 
-    @cache_for(seconds=5)
+    @cache_for(seconds=900)
     def get_last_grid_price(self):
         rs = self.client.query(
-            "select * from persist.belpex_grid_prices order by time desc limit 1"
+            "select value from persist.belpex_grid_prices order by time desc limit 1",
+            epoch='s'
         )
 
         results = []
         for r in rs.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
+            r['time'] = datetime.datetime.fromtimestamp(
+                r['time'], tz=BRUSSELS)
             results.append(r)
 
         if len(results) == 0:
@@ -71,22 +215,25 @@ class InfluxService:
     @cache_for(seconds=5)
     def get_current_power_net(self):
         rs = self.client.query(
-            "select * from (SELECT value FROM p1_elec_power_fromgrid order by time desc limit 1),"
-            "(SELECT value * -1 FROM p1_elec_power_togrid order by time desc limit 1) order by time desc"
+            "select value from (SELECT value FROM p1_elec_power_fromgrid order by time desc limit 1),"
+            "(SELECT value * -1 FROM p1_elec_power_togrid order by time desc limit 1) order by time desc",
+            epoch='s'
         )
 
-        results = []
-        for r in rs.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            results.append(r)
-
-        results = sorted(results, key=lambda x: x['time'])
+        # points are ordered by time desc, the first one is the most recent
+        result = next(rs.get_points(), None)
 
-        current_power = results[-1]['value'] * 1000
+        if result is not None:
+            current_timestamp = datetime.datetime.fromtimestamp(
+                result['time'], tz=BRUSSELS)
+            current_power = result['value'] * 1000
+        else:
+            current_timestamp = datetime.datetime.now(
+                tz=BRUSSELS)
+            current_power = 0
 
         return TimeDataDto(
-            timestamp=results[-1]['time'],
+            timestamp=current_timestamp,
             value=current_power,
             unit='W'
         )
@@ -94,26 +241,23 @@ class InfluxService:
     @cache_for(seconds=5)
     def get_current_production(self):
         now = datetime.datetime.now().astimezone(
-            pytz.utc) - datetime.timedelta(minutes=1)
+            datetime.timezone.utc) - datetime.timedelta(minutes=1)
 
         rs = self.client.query(
-            f"select * from active_power where time >= '{now.isoformat()}' order by time desc limit 1"
+            CURRENT_PRODUCTION_QUERY,
+            bind_params={'start': to_epoch_ns(now)},
+            epoch='s'
         )
 
-        results = []
-        for r in rs.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            results.append(r)
-
-        results = sorted(results, key=lambda x: x['time'])
+        result = next(rs.get_points(), None)
 
-        if len(results) > 0:
-            current_timestamp = results[-1]['time']
-            current_production = results[-1]['value']
+        if result is not None:
+            current_timestamp = datetime.datetime.fromtimestamp(
+                result['time'], tz=BRUSSELS)
+            current_production = result['value']
         else:
             current_timestamp = datetime.datetime.now(
-                tz=pytz.timezone('Europe/Brussels'))
+                tz=BRUSSELS)
             current_production = 0
 
         return TimeDataDto(
@@ -139,218 +283,123 @@ class InfluxService:
     def get_baseline_consumption(self):
         period = datetime.timedelta(hours=24)
 
-        end = datetime.datetime.now().astimezone(pytz.utc)
+        end = datetime.datetime.now().astimezone(datetime.timezone.utc)
         start = end - period
 
-        rs_fromgrid = self.client.query(
-            f"""
-        SELECT difference(last(value)) as fromgrid from p1_elec_total_fromgrid
-        where time > '{start.isoformat()}' and time <= '{end.isoformat()}'
-        group by rate, time(5m) tz('Europe/Brussels')
-        """
-        )
-
-        rs_togrid = self.client.query(
-            f"""
-        SELECT difference(last(value)) as togrid from p1_elec_total_togrid
-        where time > '{start.isoformat()}' and time <= '{end.isoformat()}'
-        group by rate, time(5m) tz('Europe/Brussels')
-        """
+        rs_fromgrid, rs_togrid, rs_production = self.client.query(
+            BASELINE_CONSUMPTION_QUERY,
+            bind_params={'start': to_epoch_ns(start), 'end': to_epoch_ns(end)}
         )
 
-        rs_production = self.client.query(
-            f"""
-        SELECT difference(last(value)) as production from accumulated_yield_energy
-        where time > '{start.isoformat()}' and time <= '{end.isoformat()}'
-        group by time(5m) tz('Europe/Brussels')
-        """
-        )
-
-        # fromgrid
-        df_rate1 = pd.DataFrame(
-            list(rs_fromgrid.get_points(tags={'rate': 'rate1'}))[:-1]
-        )
-        df_rate1 = df_rate1.set_index('time').rename(
-            columns={'fromgrid': 'rate1'})
-
-        df_rate2 = pd.DataFrame(
-            list(rs_fromgrid.get_points(tags={'rate': 'rate2'}))[:-1]
-        )
-        df_rate2 = df_rate2.set_index('time').rename(
-            columns={'fromgrid': 'rate2'})
-
-        df = pd.merge(df_rate1, df_rate2, left_index=True, right_index=True)
-        df['fromgrid'] = df.rate1 + df.rate2
-        df_result = df[['fromgrid']]
-
-        # togrid
-        df_rate1 = pd.DataFrame(
-            list(rs_togrid.get_points(tags={'rate': 'rate1'}))[:-1]
-        )
-        df_rate1 = df_rate1.set_index('time').rename(
-            columns={'togrid': 'rate1'})
-
-        df_rate2 = pd.DataFrame(
-            list(rs_togrid.get_points(tags={'rate': 'rate2'}))[:-1]
-        )
-        df_rate2 = df_rate2.set_index('time').rename(
-            columns={'togrid': 'rate2'})
+        records = []
+        for rs in (rs_fromgrid, rs_togrid, rs_production):
+            for (measurement, tags), points in rs.items():
+                rate = (tags or {}).get('rate', '')
+                records.extend(
+                    (p['time'], measurement, rate, p['value'])
+                    for p in drop_last(points))
 
-        df = pd.merge(df_rate1, df_rate2, left_index=True, right_index=True)
-        df['togrid'] = df.rate1 + df.rate2
-        df_togrid = df[['togrid']]
-
-        df_result = pd.merge(
-            df_result, df_togrid, left_index=True, right_index=True
-        )
-
-        # production
-        df_prod = pd.DataFrame(
-            list(rs_production.get_points())[:-1]
-        )
-        df_prod = df_prod.set_index('time')
-
-        df_result = pd.merge(
-            df_result, df_prod, left_index=True, right_index=True
-        )
+        df = pd.DataFrame.from_records(
+            records, columns=['time', 'measurement', 'rate', 'value'])
+        df = df.pivot_table(
+            index='time', columns=['measurement', 'rate'], values='value'
+        ).dropna()
 
         # consumption
+        df_result = pd.DataFrame(index=df.index)
         df_result['consumption'] = (
-            df_result.fromgrid + (df_result.production - df_result.togrid)) * 12
+            df[['p1_elec_total_fromgrid']].sum(axis=1)
+            + df[['accumulated_yield_energy']].sum(axis=1)
+            - df[['p1_elec_total_togrid']].sum(axis=1)) * 12
         df_result['time'] = pd.to_datetime(df_result.index)
-        df_result.consumption.describe()
+
+        consumption = df_result.consumption.to_numpy() * 1000
+        q25, q50, q75 = np.quantile(consumption, [0.25, 0.5, 0.75])
 
         return TimePeriodStatsDto(
-            start=df_result.time.min().astimezone(pytz.timezone('Europe/Brussels')),
-            end=df_result.time.max().astimezone(pytz.timezone('Europe/Brussels')),
+            start=df_result.time.min().astimezone(BRUSSELS),
+            end=df_result.time.max().astimezone(BRUSSELS),
             unit='W',
-            q25=df_result.consumption.quantile(0.25) * 1000,
-            q50=df_result.consumption.quantile(0.5) * 1000,
-            q75=df_result.consumption.quantile(0.75) * 1000,
-            stddev=df_result.consumption.std() * 1000
+            q25=q25,
+            q50=q50,
+            q75=q75,
+            stddev=consumption.std(ddof=1)
         )
 
-    @cache_for(seconds=900)
+    @cache_for(seconds=3600)
     def get_last_legionella_start(self):
         start = datetime.datetime.now().astimezone(
-            pytz.utc) - datetime.timedelta(weeks=1)
+            datetime.timezone.utc) - datetime.timedelta(weeks=1)
 
         rs_tank_temp = self.client.query(
-            f"""
-            SELECT * FROM ecodan2_tank_temp where time >= '{start.isoformat()}'
-            """
+            TANK_TEMP_QUERY,
+            bind_params={'start': to_epoch_ns(start)},
+            epoch='ns'
         )
 
-        df = pd.DataFrame(
-            list(rs_tank_temp.get_points())[:-1]
-        )
-        df['time_str'] = df.time
-        df['time'] = pd.to_datetime(df.time)
-        df = df.set_index('time')
+        times = []
+        values = []
+        for p in drop_last(rs_tank_temp.get_points()):
+            times.append(p['time'])
+            values.append(p['value'])
 
-        df = df[df.value >= 60]
-        df['time_cyclus_should_end'] = df.index + \
-            datetime.timedelta(minutes=20)
-        df['time_cyclus_end'] = pd.to_datetime(df.time_str.shift(periods=-40))
+        times = np.array(times, dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
 
-        df = df[df['time_cyclus_should_end'] ==
-                df['time_cyclus_end']].sort_index()
+        # a legionella cycle keeps the tank at 60° C or more for 20 minutes,
+        # i.e. 40 consecutive samples
+        hot = values >= 60
+        times = times[hot]
+        values = values[hot]
 
-        if len(df) > 0:
-            last_legionella = df.iloc[-1]
+        cycles = np.flatnonzero(
+            times[40:] - times[:-40] == 20 * 60 * 10**9)
+
+        if len(cycles) > 0:
+            last_legionella = cycles[-1]
 
             return TimeDataDto(
-                timestamp=last_legionella.name.astimezone(
-                    pytz.timezone('Europe/Brussels')),
-                value=last_legionella.value,
+                timestamp=datetime.datetime.fromtimestamp(
+                    times[last_legionella] / 10**9, tz=BRUSSELS),
+                value=values[last_legionella],
                 unit='° C'
             )
         else:
             return TimeDataDto(
                 timestamp=datetime.datetime(1970, 1, 1, 0, 0, 0, 0).astimezone(
-                    pytz.timezone('Europe/Brussels')),
+                    BRUSSELS),
                 value=-1,
                 unit='° C'
             )
 
-    @cache_for(seconds=5)
+    @cache_for(seconds=10)
     def get_current_heatpump_status(self):
         start = datetime.datetime.now().astimezone(
-            pytz.utc) - datetime.timedelta(minutes=2)
-
-        operating_modes = {
-            0: 'Stop',
-            1: 'Hot water',
-            2: 'Heating',
-            3: 'Cooling',
-            4: 'No voltage contact input (hot water storage)',
-            5: 'Freeze stat',
-            6: 'Legionella',
-            7: 'Heating eco',
-            8: 'Mode 1',
-            9: 'Mode 2',
-            10: 'Mode 3',
-            11: 'No voltage contact input (heating up)'
-        }
+            datetime.timezone.utc) - datetime.timedelta(minutes=2)
 
-        rs_operating_mode = self.client.query(
-            f"select * from ecodan2_operating_mode where time >= '{start.isoformat()}'order by time desc limit 1"
+        rs = self.client.query(
+            HEATPUMP_STATUS_QUERY,
+            bind_params={'start': to_epoch_ns(start)}
         )
 
-        om = list(rs_operating_mode.get_points())
-        if len(om) == 0:
-            om = -99
-        else:
-            om = om[-1]['value']
-        operating_mode = operating_modes.get(om, 'Unknown')
-
-        heat_sources = {
-            0: 'Heatpump',
-            1: 'Immersion heater',
-            2: 'Backup heater',
-            3: 'Immersion and backup heater',
-            4: 'Boiler'
-        }
+        # one series per measurement, holding its last value
+        last_values = {}
+        for (measurement, _), points in rs.items():
+            for r in points:
+                last_values[measurement] = r['last']
 
-        rs_heat_source = self.client.query(
-            f"select * from ecodan2_heat_source where time >= '{start.isoformat()}'order by time desc limit 1"
-        )
+        om = last_values.get('ecodan2_operating_mode', -99)
+        operating_mode = OPERATING_MODES.get(om, 'Unknown')
 
-        hs = list(rs_heat_source.get_points())
-        if len(hs) == 0:
-            hs = -99
-        else:
-            hs = hs[-1]['value']
-        heat_source = heat_sources.get(hs, 'Unknown')
+        hs = last_values.get('ecodan2_heat_source', -99)
+        heat_source = HEAT_SOURCES.get(hs, 'Unknown')
 
-        if heat_source == 'Heatpump':
-            rs_freq = self.client.query(
-                f"select * from ecodan2_pump_freq where time >= '{start.isoformat()}'order by time desc limit 1"
-            )
+        if heat_source == 'Heatpump' \
+                and last_values.get('ecodan2_pump_freq') == 0:
+            heat_source = 'Heatpump pause'
 
-            freq = list(rs_freq.get_points())
-            if len(freq) > 0:
-                freq = freq[-1]['value']
-                if freq == 0:
-                    heat_source = 'Heatpump pause'
-
-        defrost_statuses = {
-            0: 'Normal',
-            1: 'Standby',
-            2: 'Defrost',
-            3: 'Waiting restart'
-        }
-
-        rs_defrost_status = self.client.query(
-            f"select * from ecodan2_defrost_status where time >= '{start.isoformat()}'order by time desc limit 1"
-        )
-
-        ds = list(rs_defrost_status.get_points())
-        if len(ds) == 0:
-            ds = -99
-        else:
-            ds = ds[-1]['value']
-        defrost_status = defrost_statuses.get(ds, 'Unknown')
+        ds = last_values.get('ecodan2_defrost_status', -99)
+        defrost_status = DEFROST_STATUSES.get(ds, 'Unknown')
 
         return HeatPumpStatusDto(
             operating_mode=operating_mode,
@@ -358,13 +407,14 @@ class InfluxService:
             defrost_status=defrost_status
         )
 
-    @cache_for(seconds=5)
+    @cache_for(seconds=10)
     def get_heatpump_setpoint(self):
         start = datetime.datetime.now().astimezone(
-            pytz.utc) - datetime.timedelta(minutes=2)
+            datetime.timezone.utc) - datetime.timedelta(minutes=2)
 
-        rs_dhw_setpoint = self.client.query(
-            f"select * from ecodan2_tank_set_temp where time >= '{start.isoformat()}'order by time desc limit 1"
+        rs_dhw_setpoint, rs_heating_setpoint = self.client.query(
+            HEATPUMP_SETPOINT_QUERY,
+            bind_params={'start': to_epoch_ns(start)}
         )
 
         dhw_setpoint = list(rs_dhw_setpoint.get_points())
@@ -373,10 +423,6 @@ class InfluxService:
         else:
             dhw_setpoint = dhw_setpoint[-1]['value']
 
-        rs_heating_setpoint = self.client.query(
-            f"select * from ecodan2_house_set_temp where time >= '{start.isoformat()}'order by time desc limit 1"
-        )
-
         heating_setpoint = list(rs_heating_setpoint.get_points())
         if len(heating_setpoint) == 0:
             heating_setpoint = None
@@ -391,26 +437,23 @@ class InfluxService:
     @cache_for(seconds=5)
     def get_current_dhw_temp(self):
         start = datetime.datetime.now().astimezone(
-            pytz.utc) - datetime.timedelta(minutes=2)
+            datetime.timezone.utc) - datetime.timedelta(minutes=2)
 
         rs_dhw_temp = self.client.query(
-            f"select * from ecodan2_tank_temp where time >= '{start.isoformat()}'order by time desc limit 1"
+            CURRENT_DHW_TEMP_QUERY,
+            bind_params={'start': to_epoch_ns(start)},
+            epoch='s'
         )
 
-        results = []
-        for r in rs_dhw_temp.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            results.append(r)
-
-        results = sorted(results, key=lambda x: x['time'])
+        result = next(rs_dhw_temp.get_points(), None)
 
-        if len(results) == 0:
+        if result is None:
             timestamp = None
             dhw_temp = None
         else:
-            timestamp = results[-1]['time']
-            dhw_temp = results[-1]['value']
+            timestamp = datetime.datetime.fromtimestamp(
+                result['time'], tz=BRUSSELS)
+            dhw_temp = result['value']
 
         return TimeDataDto(
             timestamp=timestamp,
@@ -418,32 +461,25 @@ class InfluxService:
             unit='° C'
         )
 
-    @cache_for(seconds=14400)
+    @cache_for(seconds=300)
     def get_current_month_peak(self):
         today = datetime.date.today()
         start_date = datetime.date(today.year, today.month, 1)
         end_date = start_date + relativedelta(months=1)
 
         rs_peak = self.client.query(
-            f"""
-                select max(peak) as peak from (
-                    select sum(peak) as peak from (
-                        SELECT difference(last(value)) *4 as peak, first(month) as month, first(year) as year
-                        from "persist".p1_elec_total_fromgrid_max
-                        where time >= '{start_date.strftime('%Y-%m-%d')}'
-                        and time < '{end_date.strftime('%Y-%m-%d')}' - 15m
-                        group by rate, month, year, time(15m) tz('Europe/Brussels')
-                    ) group by month, year, time(15m) tz('Europe/Brussels')
-                ) group by month, year
-            """
+            PEAK_QUERY,
+            bind_params={
+                'start': start_date.strftime('%Y-%m-%d'),
+                'end': end_date.strftime('%Y-%m-%d')
+            }
         )
 
         result_sum = 0
         result_count = 0
         for r in rs_peak.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result_sum += max(r['peak'], 2.5)
+            peak = r['peak']
+            result_sum += peak if peak > 2.5 else 2.5
             result_count += 1
 
         return result_sum/result_count
@@ -455,37 +491,27 @@ class InfluxService:
         period_end = month_start + relativedelta(months=1)
 
         rs_peak = self.client.query(
-            f"""
-                select max(peak) as peak from (
-                    select sum(peak) as peak from (
-                        SELECT difference(last(value)) *4 as peak, first(month) as month, first(year) as year
-                        from "persist".p1_elec_total_fromgrid_max
-                        where time >= '{period_start.strftime('%Y-%m-%d')}'
-                        and time < '{period_end.strftime('%Y-%m-%d')}' - 15m
-                        group by rate, month, year, time(15m) tz('Europe/Brussels')
-                    ) group by month, year, time(15m) tz('Europe/Brussels')
-                ) group by month, year
-            """
+            PEAK_QUERY,
+            bind_params={
+                'start': period_start.strftime('%Y-%m-%d'),
+                'end': period_end.strftime('%Y-%m-%d')
+            }
         )
 
         result_sum = 0
         result_count = 0
         for r in rs_peak.get_points():
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result_sum += max(r['peak'], 2.5)
+            peak = r['peak']
+            result_sum += peak if peak > 2.5 else 2.5
             result_count += 1
 
         return result_sum/result_count
 
-    @cache_for(seconds=14400)
+    @cache_for(seconds=14400, negative_ttl=60)
     def get_monthly_belpex(self, year, month):
         rs_belpex = self.client.query(
-            f"""
-                select mean(value) as belpex from
-                "persist".belpex_grid_prices
-                where "year" = '{year}' and "month"='{month}'
-            """
+            MONTHLY_BELPEX_QUERY,
+            bind_params={'year': str(year), 'month': str(month)}
         )
 
         results = []
@@ -497,90 +523,42 @@ class InfluxService:
         else:
             return results[0]['belpex']
 
-    @cache_for(seconds=300)
+    @cache_for(seconds=300, negative_ttl=60)
     def get_hourly_energy_consumption_injection(self, start_date, end_date):
-        rs_consumption = self.client.query(
-            f"""
-                select difference(last(value)) as consumption
-                from persist.p1_elec_total_fromgrid
-                where time >= '{start_date.strftime('%Y-%m-%d')}'
-                and time < '{end_date.strftime('%Y-%m-%d')}'
-                group by rate, time(1h)
-                tz('Europe/Brussels')
-            """
-        )
-
-        result = []
-        for r in rs_consumption.get_points(tags={'rate': 'rate1'}):
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result.append(r)
-
-        if len(result) > 0:
-            df = pd.DataFrame(result)
-            df = df.set_index('time')
-            df = df.rename(columns={'consumption': 'consumption_rate1'})
-        else:
-            df = None
-
-        result = []
-        for r in rs_consumption.get_points(tags={'rate': 'rate2'}):
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result.append(r)
-
-        if len(result) > 0:
-            df_temp = pd.DataFrame(result).set_index('time').rename(
-                columns={'consumption': 'consumption_rate2'})
-        else:
-            df_temp = None
+        bind_params = {
+            'start': start_date.strftime('%Y-%m-%d'),
+            'end': end_date.strftime('%Y-%m-%d')
+        }
 
-        if df is None or df_temp is None:
-            df = df or df_temp
-        else:
-            df = pd.merge(df, df_temp, left_index=True, right_index=True)
-
-        rs_injection = self.client.query(
-            f"""
-                select difference(last(value)) as injection
-                from persist.p1_elec_total_togrid
-                where time >= '{start_date.strftime('%Y-%m-%d')}'
-                and time < '{end_date.strftime('%Y-%m-%d')}'
-                group by rate, time(1h)
-                tz('Europe/Brussels')
-            """
+        # both queries are independent, run them concurrently
+        future_consumption = QUERY_POOL.submit(
+            self.client.query,
+            HOURLY_CONSUMPTION_QUERY,
+            bind_params=bind_params
+        )
+        future_injection = QUERY_POOL.submit(
+            self.client.query,
+            HOURLY_INJECTION_QUERY,
+            bind_params=bind_params
         )
 
-        result = []
-        for r in rs_injection.get_points(tags={'rate': 'rate1'}):
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result.append(r)
-
-        if len(result) > 0:
-            df_temp = pd.DataFrame(result).set_index('time').rename(
-                columns={'injection': 'injection_rate1'})
-            df = pd.merge(df, df_temp, left_index=True, right_index=True)
+        rs_consumption = future_consumption.result()
+        rs_injection = future_injection.result()
 
-        result = []
-        for r in rs_injection.get_points(tags={'rate': 'rate2'}):
-            r['time'] = to_brussels_time(
-                datetime.datetime.strptime(r['time'], '%Y-%m-%dT%H:%M:%SZ'))
-            result.append(r)
+        frames = rates_to_frames(rs_consumption, 'consumption') + \
+            rates_to_frames(rs_injection, 'injection')
 
-        if len(result) > 0:
-            df_temp = pd.DataFrame(result).set_index('time').rename(
-                columns={'injection': 'injection_rate2'})
-            df = pd.merge(df, df_temp, left_index=True, right_index=True)
+        if len(frames) == 0:
+            return None
 
-        return df
+        return pd.concat(frames, axis=1, join='inner')
 
     def save_grid_prices(self, grid_data):
         data = []
 
         for d in grid_data:
             data.append({
-                'time': int(d.timestamp.timestamp()) * 10**9,
+                'time': int(d.timestamp.timestamp()),
                 'measurement': 'belpex_grid_prices',
                 'fields': {
                     'value': d.value * 1.0
@@ -592,4 +570,10 @@ class InfluxService:
                 }
             })
 
-        self.client.write_points(data, retention_policy="persist")
+        self.client.write_points(
+            data, time_precision='s', retention_policy="persist",
+            batch_size=5000)
+
+    def __scheduled_jobs(self):
+        self.app.scheduler.add_job(
+            self.update_current_values, 'interval', seconds=5)
@@ -14,11 +14,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import numpy as np
 import pandas as pd
 
-import calendar
+import concurrent.futures
 import datetime
 
+from services.cache import cache_for
+from utils.time import BRUSSELS
+
+# separate from the influx query pool, as each segment waits on queries there
+SEGMENT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+HOURS_IN_YEAR = 365 * 24
+HOURS_IN_LEAP_YEAR = 366 * 24
+
+PRICE_COLUMNS = ['fixed', 'peak', 'distribution',
+                 'consumption', 'injection', 'total']
+
+
+def empty_price_frame():
+    # callers still need to check .empty before positional access like iloc[0]
+    return pd.DataFrame(
+        {column: pd.Series(dtype='float64') for column in PRICE_COLUMNS},
+        index=pd.DatetimeIndex([], tz=BRUSSELS, name='time'))
+
 
 class PriceService:
     def __init__(self, app):
@@ -30,35 +50,39 @@ class PriceService:
         }
 
     def get_aggregated_price(self, start_date, end_date, freq):
-        date_range = [start_date, end_date]
-        year_ends = [i.to_pydatetime().date() + datetime.timedelta(days=1) for i in pd.date_range(
-            start_date, end_date, freq='YE')]
-        year_ends *= 2
-        date_range.extend(year_ends)
-        date_range = sorted(date_range)
+        # the cached frame is shared between callers, hand out a copy
+        return self.__get_aggregated_price(start_date, end_date, freq).copy()
 
-        result = pd.DataFrame()
+    @cache_for(seconds=300)
+    def __get_aggregated_price(self, start_date, end_date, freq):
+        futures = []
 
-        for i in range(int(len(date_range) / 2)):
-            start_date = date_range[i*2]
-            end_date = date_range[(i*2)+1]
+        for year in range(start_date.year, end_date.year + 1):
+            year_start = max(start_date, datetime.date(year, 1, 1))
+            year_end = min(end_date, datetime.date(year + 1, 1, 1))
 
-            if start_date == end_date:
+            if year_start >= year_end:
+                self.app.log.debug(
+                    'Skipping empty price window %s - %s', year_start, year_end)
                 continue
 
-            calculation = self.price_calculation.get(start_date.year, None)
+            calculation = self.price_calculation.get(year, None)
 
             if calculation is None:
                 raise ValueError(
-                    f'No price calculation exists for the year {start_date.year}')
+                    f'No price calculation exists for the year {year}')
+
+            # the yearly segments are independent, aggregate them concurrently
+            futures.append(SEGMENT_POOL.submit(
+                calculation.get_aggregated_price, year_start, year_end, freq))
 
-            price = calculation.get_aggregated_price(
-                start_date, end_date, freq)
+        parts = [f.result() for f in futures]
+        parts = [price for price in parts if not price.empty]
 
-            if price is not None:
-                result = pd.concat([result, price])
+        if len(parts) == 0:
+            return empty_price_frame()
 
-        return result
+        return pd.concat(parts)
 
     def get_monthly_price(self, start_date, end_date):
         return self.get_aggregated_price(start_date, end_date, 'MS')
@@ -82,20 +106,20 @@ class AbstractPriceCalculation:
         """Get the montly energy consumption and injection between given start date and end date."""
         return self.app.services.influx.get_hourly_energy_consumption_injection(start_date, end_date)
 
-    def get_consumption_rate1_price(self, timestamp):
-        """Get the price per kWh for rate1 (high) consumption for the given timestamp."""
+    def get_consumption_rate1_price(self, timestamps):
+        """Get the prices per kWh for rate1 (high) consumption for the given timestamps."""
         raise NotImplementedError
 
-    def get_consumption_rate2_price(self, timestamp):
-        """Get the price per kWh for rate2 (low) consumption for the given timestamp."""
+    def get_consumption_rate2_price(self, timestamps):
+        """Get the prices per kWh for rate2 (low) consumption for the given timestamps."""
         raise NotImplementedError
 
-    def get_injection_rate1_price(self, timestamp):
-        """Get the price per kWh for rate1 (high) injection for the given timestamp."""
+    def get_injection_rate1_price(self, timestamps):
+        """Get the prices per kWh for rate1 (high) injection for the given timestamps."""
         raise NotImplementedError
 
-    def get_injection_rate2_price(self, timestamp):
-        """Get the price per kWh for rate2 (low) consumption for the given timestamp."""
+    def get_injection_rate2_price(self, timestamps):
+        """Get the prices per kWh for rate2 (low) consumption for the given timestamps."""
         raise NotImplementedError
 
     def get_subscription_price(self):
@@ -122,11 +146,10 @@ class AbstractPriceCalculation:
         energy_stats = self.get_hourly_energy_consumption_injection(
             start_date, end_date)
 
-        if energy_stats is not None:
-            energy_stats = energy_stats.apply(
-                self.calculate_price, axis=1, result_type='expand')
+        if energy_stats is None:
+            return empty_price_frame()
 
-            return energy_stats.groupby(pd.Grouper(freq=freq)).agg('sum')
+        return self.calculate_prices(energy_stats).resample(freq).sum()
 
     def get_monthly_price(self, start_date, end_date):
         return self.get_aggregated_price(start_date, end_date, 'MS')
@@ -137,64 +160,95 @@ class AbstractPriceCalculation:
     def get_hourly_price(self, start_date, end_date):
         return self.get_aggregated_price(start_date, end_date, '1H')
 
-    def calculate_price(self, df_row):
-        timestamp = df_row.name
+    def calculate_prices(self, energy_stats):
+        timestamps = energy_stats.index
+
+        hours_in_year = np.where(
+            timestamps.is_leap_year, HOURS_IN_LEAP_YEAR, HOURS_IN_YEAR)
+        hours_in_month = timestamps.days_in_month.to_numpy() * 24
+
+        months = timestamps.year * 100 + timestamps.month
+        invoice_peak = months.map({
+            m: self.get_invoice_peak(int(m) // 100, int(m) % 100)
+            for m in months.unique()}).to_numpy()
 
-        hours_in_year = 365 * 24
-        if calendar.isleap(timestamp.year):
-            hours_in_year += 24
+        consumption_rate1_price = self.get_consumption_rate1_price(timestamps)
+        consumption_rate2_price = self.get_consumption_rate2_price(timestamps)
+        injection_rate1_price = self.get_injection_rate1_price(timestamps)
+        injection_rate2_price = self.get_injection_rate2_price(timestamps)
 
-        days_in_month = calendar.monthrange(timestamp.year, timestamp.month)[1]
-        hours_in_month = days_in_month * 24
+        consumption_rate1 = energy_stats.consumption_rate1.to_numpy()
+        consumption_rate2 = energy_stats.consumption_rate2.to_numpy()
+        injection_rate1 = energy_stats.injection_rate1.to_numpy()
+        injection_rate2 = energy_stats.injection_rate2.to_numpy()
 
         fixed_component = self.get_subscription_price() / hours_in_year
         fixed_component += self.get_eneryfund_price() / hours_in_year
         fixed_component += self.get_distribution_price_fixed() / hours_in_month
 
         distrib_peak_component = self.get_distribution_price_per_kW_peak(
-        ) * self.get_invoice_peak(timestamp.year, timestamp.month) / hours_in_year
+        ) * invoice_peak / hours_in_year
 
         distrib_dynamic_component = self.get_distribution_price_per_kWh() * (
-            df_row.consumption_rate1 + df_row.consumption_rate2
+            consumption_rate1 + consumption_rate2
         )
 
-        consumption_price = self.get_consumption_rate1_price(
-            timestamp) * df_row.consumption_rate1
-        consumption_price += self.get_consumption_rate2_price(
-            timestamp) * df_row.consumption_rate2
+        consumption_price = consumption_rate1_price * consumption_rate1
+        consumption_price += consumption_rate2_price * consumption_rate2
 
-        injection_price = self.get_injection_rate1_price(
-            timestamp) * df_row.injection_rate1
-        injection_price += self.get_injection_rate2_price(
-            timestamp) * df_row.injection_rate2
+        injection_price = injection_rate1_price * injection_rate1
+        injection_price += injection_rate2_price * injection_rate2
 
         total = (fixed_component + distrib_peak_component +
                  distrib_dynamic_component + consumption_price - injection_price)
 
-        return pd.Series(
-            [fixed_component, distrib_peak_component, distrib_dynamic_component,
-             consumption_price, -injection_price, total],
-            index=['fixed', 'peak', 'distribution', 'consumption', 'injection', 'total'])
+        return pd.DataFrame({
+            'fixed': fixed_component,
+            'peak': distrib_peak_component,
+            'distribution': distrib_dynamic_component,
+            'consumption': consumption_price,
+            'injection': -injection_price,
+            'total': total
+        }, index=timestamps)
 
 
 class AbstractDynamicPriceCalculation(AbstractPriceCalculation):
-    def get_monthly_belpex(self, timestamp):
-        """Get mean belpex day ahead price in c€/kWh for the given month and year."""
-        return self.app.services.influx.get_monthly_belpex(timestamp.year, timestamp.month)
+    # (slope, intercept) of the price per kWh in function of the monthly belpex in c€/kWh
+    CONSUMPTION_RATE1 = None
+    CONSUMPTION_RATE2 = None
+    INJECTION_RATE1 = None
+    INJECTION_RATE2 = None
 
+    def get_monthly_belpex(self, timestamps):
+        """Get mean belpex day ahead prices in c€/kWh for the months of the given timestamps."""
+        months = timestamps.year * 100 + timestamps.month
+        belpex = {m: self.app.services.influx.get_monthly_belpex(int(m) // 100, int(m) % 100)
+                  for m in months.unique()}
+        return months.map(belpex).to_numpy()
 
-class PriceCalculationWaseWind2024(AbstractDynamicPriceCalculation):
-    def get_consumption_rate1_price(self, timestamp):
-        return (0.115 * 0.5 * self.get_monthly_belpex(timestamp) * 10 + 7.46) / 100
+    def get_rate_price(self, timestamps, coefficients):
+        """Get the prices per kWh as slope * belpex + intercept for the given timestamps."""
+        slope, intercept = coefficients
+        return slope * self.get_monthly_belpex(timestamps) + intercept
+
+    def get_consumption_rate1_price(self, timestamps):
+        return self.get_rate_price(timestamps, self.CONSUMPTION_RATE1)
+
+    def get_consumption_rate2_price(self, timestamps):
+        return self.get_rate_price(timestamps, self.CONSUMPTION_RATE2)
+
+    def get_injection_rate1_price(self, timestamps):
+        return self.get_rate_price(timestamps, self.INJECTION_RATE1)
 
-    def get_consumption_rate2_price(self, timestamp):
-        return (0.100 * 0.5 * self.get_monthly_belpex(timestamp) * 10 + 6.63) / 100
+    def get_injection_rate2_price(self, timestamps):
+        return self.get_rate_price(timestamps, self.INJECTION_RATE2)
 
-    def get_injection_rate1_price(self, timestamp):
-        return (0.08 * self.get_monthly_belpex(timestamp) * 10 - 0.6) / 100
 
-    def get_injection_rate2_price(self, timestamp):
-        return (0.06 * self.get_monthly_belpex(timestamp) * 10 - 0.6) / 100
+class PriceCalculationWaseWind2024(AbstractDynamicPriceCalculation):
+    CONSUMPTION_RATE1 = (0.115 * 0.5 * 10 / 100, 7.46 / 100)
+    CONSUMPTION_RATE2 = (0.100 * 0.5 * 10 / 100, 6.63 / 100)
+    INJECTION_RATE1 = (0.08 * 10 / 100, -0.6 / 100)
+    INJECTION_RATE2 = (0.06 * 10 / 100, -0.6 / 100)
 
     def get_subscription_price(self):
         return 60
@@ -225,17 +279,10 @@ class PriceCalculationWaseWind2024(AbstractDynamicPriceCalculation):
 
 
 class PriceCalculationWaseWind2025(AbstractDynamicPriceCalculation):
-    def get_consumption_rate1_price(self, timestamp):
-        return (0.115 * 0.5 * self.get_monthly_belpex(timestamp) * 10 + 7.16) / 100
-
-    def get_consumption_rate2_price(self, timestamp):
-        return (0.100 * 0.5 * self.get_monthly_belpex(timestamp) * 10 + 6.36) / 100
-
-    def get_injection_rate1_price(self, timestamp):
-        return (0.07 * self.get_monthly_belpex(timestamp) * 10 - 1) / 100
-
-    def get_injection_rate2_price(self, timestamp):
-        return (0.05 * self.get_monthly_belpex(timestamp) * 10 - 1) / 100
+    CONSUMPTION_RATE1 = (0.115 * 0.5 * 10 / 100, 7.16 / 100)
+    CONSUMPTION_RATE2 = (0.100 * 0.5 * 10 / 100, 6.36 / 100)
+    INJECTION_RATE1 = (0.07 * 10 / 100, -1 / 100)
+    INJECTION_RATE2 = (0.05 * 10 / 100, -1 / 100)
 
     def get_subscription_price(self):
         return 65